@@ -16,15 +16,30 @@ def write_csv(data, filename):
         data.to_csv(filename, sep=",", index_label="", compression="gzip")
     elif filename.endswith(".tsv.gz"):
         data.to_csv(filename, sep="\t", index_label="", compression="gzip")
+    elif filename.endswith(".feather"):
+        # Binary columnar format (requires `feather-format` for pandas<0.24, `pyarrow` otherwise)
+        data.reset_index().to_feather(filename)
     else:
         raise NotImplementedError("Unrecognized format for file %s" % filename)
 
 
+def write_commented_table(data, file, prefix="## "):
+    # Writes `data` to an open text file as tab separated lines starting with `prefix` (e.g. in result files)
+    file.write(prefix + "\t" + "\t".join(str(column) for column in data.columns.values) + "\n")
+    file.writelines("%s%s\t%s\n" % (prefix, label, "\t".join("%.6g" % value for value in row))
+                    for label, row in zip(data.index.values, data.values))
+
+
 def read_table_file(filename):
     if filename.endswith(".csv") or filename.endswith(".tsv") or \
             filename.endswith(".csv.gz") or filename.endswith(".tsv.gz"):
         return read_csv(filename)
     elif filename.endswith(".pkl.gz"):
         return load_gzip_pickle(filename)
+    elif filename.endswith(".feather"):
+        data = pd.read_feather(filename)
+        data = data.set_index(data.columns[0])
+        data.index.name = None
+        return data
     else:
         raise NotImplementedError("Unrecognized format for file %s" % filename)
@@ -1,4 +1,6 @@
 import numpy as np
+import pandas as pd
+from scipy import sparse
 
 
 normalizations = {
@@ -37,3 +39,62 @@ def rearrange_and_rename_columns(data, original_columns, column_permutation):
     rearranged_data.columns = original_columns
 
     return rearranged_data
+
+
+def remove_zero_rows(data):
+    # Filters rows on the underlying array (fancy indexing already returns a copy)
+    values = data.values
+    non_zero_rows = values.any(axis=1)
+    return pd.DataFrame(values[non_zero_rows], index=data.index[non_zero_rows], columns=data.columns)
+
+
+def _get_compact_dtype(values):
+    # Smallest unsigned integer type holding all values if they are non-negative integers (e.g. counts)
+    if values.size > 0 and (values.min() < 0 or not np.all(np.mod(values, 1) == 0)):
+        return None
+    max_value = values.max() if values.size > 0 else 0
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return None
+
+
+# Compact (CSR) representation of mostly-zero data frames for storage (restored by `to_dense`)
+def to_sparse(data):
+    matrix = sparse.csr_matrix(data.values)
+    original_dtype = matrix.dtype
+    compact_dtype = _get_compact_dtype(matrix.data)
+    if compact_dtype is not None:
+        matrix = matrix.astype(compact_dtype)
+    return matrix, data.index, data.columns, original_dtype
+
+
+def to_dense(sparse_data):
+    # Older test benches stored pandas sparse data frames instead
+    if not isinstance(sparse_data, tuple) or not sparse.issparse(sparse_data[0]):
+        raise ValueError("Hidden data was generated in an old format, please regenerate the test bench.")
+    matrix, index, columns = sparse_data[:3]
+    # Data saved before down-casting was introduced has no original dtype
+    dtype = sparse_data[3] if len(sparse_data) > 3 else matrix.dtype
+    return pd.DataFrame(matrix.toarray().astype(dtype, copy=False), index=index, columns=columns)
+
+
+# Named arrays of `to_sparse` results, so that they can be stored without pickle (e.g. with `np.savez_compressed`)
+def sparse_to_arrays(sparse_data, prefix):
+    matrix, index, columns, dtype = sparse_data
+    return {
+        prefix + "data": matrix.data,
+        prefix + "indices": matrix.indices,
+        prefix + "indptr": matrix.indptr,
+        prefix + "shape": np.array(matrix.shape),
+        prefix + "index": np.asarray(index, dtype=str),
+        prefix + "columns": np.asarray(columns, dtype=str),
+        prefix + "dtype": np.array(np.dtype(dtype).str)
+    }
+
+
+def arrays_to_sparse(arrays, prefix):
+    matrix = sparse.csr_matrix((arrays[prefix + "data"], arrays[prefix + "indices"], arrays[prefix + "indptr"]),
+                               shape=tuple(arrays[prefix + "shape"]))
+    return matrix, pd.Index(arrays[prefix + "index"]), pd.Index(arrays[prefix + "columns"]), \
+        np.dtype(str(arrays[prefix + "dtype"]))
@@ -1,9 +1,13 @@
 import abc
+import os
 import random as py_random
 
 import six
 from numpy import random as np_random
 
+from general.conf import settings
+from utils.base import make_sure_dir_exists, calculate_md5_sum
+
 
 @six.add_metaclass(abc.ABCMeta)
 class AbstractEvaluator:
@@ -56,6 +60,19 @@ class AbstractEvaluator:
         """
         pass
 
+    def _get_embedded_data_file_path(self, processed_count_file, normalization, transformation, seed):
+        """
+        Path of cached embeddings of processed data (they only depend on the data, its preprocessing and the seed).
+        :param processed_count_file: The processed file, which embeddings are calculated for.
+        :param normalization: Normalization applied before embedding.
+        :param transformation: Transformation applied before embedding.
+        :param seed: Random generator seed used for embedding.
+        :return: Returns the cache file path in `STORAGE_DIR`.
+        """
+        make_sure_dir_exists(settings.STORAGE_DIR)
+        return os.path.join(settings.STORAGE_DIR, "%s.%s.%s.%s.%s.embedded_data.pkl.gz" %
+                            (self.uid, calculate_md5_sum(processed_count_file), normalization, transformation, seed))
+
     @staticmethod
     def set_seed(seed):
         """
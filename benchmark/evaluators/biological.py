@@ -2,11 +2,8 @@ import os
 
 import numpy as np
 import pandas as pd
-import umap
 from sklearn import svm
 from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA, TruncatedSVD, FastICA
-from sklearn.manifold import TSNE
 from sklearn.metrics import calinski_harabaz_score, silhouette_score, accuracy_score
 from sklearn.metrics.cluster import adjusted_mutual_info_score, v_measure_score
 from sklearn.model_selection import train_test_split
@@ -14,13 +11,18 @@ from sklearn.neighbors import KNeighborsClassifier
 
 from data.data_set import get_data_set_class
 from data.io import read_table_file, write_csv
-from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, normalizations, transformations
+from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, normalizations, transformations, \
+    to_sparse, to_dense
 from evaluators.base import AbstractEvaluator
 from general.conf import settings
 from utils.base import make_sure_dir_exists, log, dump_gzip_pickle, load_gzip_pickle
+from utils.plotting import write_image
+from utils.reducers import reduce_dimensions
 
 
 class CellCyclePreservationEvaluator(AbstractEvaluator):
+    EMBEDDINGS = ["PCA", "ICA", "Truncated SVD", "tSNE", "UMAP"]
+
     def __init__(self, uid):
         super(CellCyclePreservationEvaluator, self).__init__(uid)
 
@@ -69,12 +71,13 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
         data = self._load_and_combine_data()
 
         # Remove some rows and columns
+        removed_prefixes = []
         if rm_ercc:
-            remove_list = [symbol for symbol in data.index.values if symbol.startswith("ERCC-")]
-            data = data.drop(remove_list)
+            removed_prefixes.append("ERCC-")
         if rm_mt:
-            remove_list = [symbol for symbol in data.index.values if symbol.startswith("mt-")]
-            data = data.drop(remove_list)
+            removed_prefixes.append("mt-")
+        if removed_prefixes:
+            data = data[~data.index.str.match("^(%s)" % "|".join(removed_prefixes))]
         if rm_lq:
             remove_list = data.columns.values[data.sum(axis=0) < 1e6]
             data = data.drop(columns=remove_list)
@@ -88,7 +91,7 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
         # Save hidden data
         make_sure_dir_exists(settings.STORAGE_DIR)
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        dump_gzip_pickle([data.to_sparse(), original_columns, column_permutation], hidden_data_file_path)
+        dump_gzip_pickle([to_sparse(data), original_columns, column_permutation], hidden_data_file_path)
         log("Benchmark hidden data saved to `%s`" % hidden_data_file_path)
 
         make_sure_dir_exists(os.path.dirname(count_file_path))
@@ -100,7 +103,7 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
     def _load_data_and_imputed_data_for_evaluation(self, processed_count_file):
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
         sparse_data, original_columns, column_permutation = load_gzip_pickle(hidden_data_file_path)
-        data = sparse_data.to_dense()
+        data = to_dense(sparse_data)
         del sparse_data
 
         imputed_data = read_table_file(processed_count_file)
@@ -109,10 +112,10 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
         imputed_data = rearrange_and_rename_columns(imputed_data, original_columns, column_permutation)
 
         # Remove (error correction) ERCC and mitochondrial RNAs
-        remove_list = [symbol for symbol in imputed_data.index.values
-                       if symbol.startswith("ERCC-") or symbol.startswith("mt-")]
+        is_removed = imputed_data.index.str.match("^(ERCC-|mt-)")
+        remove_list = imputed_data.index[is_removed]
 
-        imputed_data = imputed_data.drop(remove_list)
+        imputed_data = imputed_data[~is_removed]
         data = data.drop(remove_list)
 
         return data, imputed_data
@@ -145,41 +148,37 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
                               "ENSMUSG00000048327", "ENSMUSG00000048922", "ENSMUSG00000054717", "ENSMUSG00000062248",
                               "ENSMUSG00000068744", "ENSMUSG00000074802"]
 
-        G1_S_related_part_of_data = data.loc[G1_S_related_genes]
-        G2_M_related_part_of_data = data.loc[G2_M_related_genes]
+        # Marker genes missing in data (e.g. filtered ones) are skipped
+        G1_S_related_genes = pd.Index(G1_S_related_genes)
+        G2_M_related_genes = pd.Index(G2_M_related_genes)
+        G1_S_related_part_of_data = data.reindex(G1_S_related_genes[G1_S_related_genes.isin(data.index)])
+        G2_M_related_part_of_data = data.reindex(G2_M_related_genes[G2_M_related_genes.isin(data.index)])
 
         return G1_S_related_part_of_data, G2_M_related_part_of_data
 
     @staticmethod
-    def _get_embeddings(related_part_of_imputed_data):
-        emb_pca = PCA(n_components=2). \
-            fit_transform(related_part_of_imputed_data.transpose())
-        emb_ica = FastICA(n_components=2). \
-            fit_transform(related_part_of_imputed_data.transpose())
-        emb_tsvd = TruncatedSVD(n_components=2). \
-            fit_transform(related_part_of_imputed_data.transpose())
-        emb_tsne = TSNE(n_components=2, method='exact'). \
-            fit_transform(related_part_of_imputed_data.transpose())
-        emb_umap = umap.UMAP(n_components=2, n_neighbors=4, min_dist=0.3, metric='correlation'). \
-            fit_transform(related_part_of_imputed_data.transpose())
-
-        embedded_data = {
-            "PCA": emb_pca,
-            "ICA": emb_ica,
-            "Truncated SVD": emb_tsvd,
-            "tSNE": emb_tsne,
-            "UMAP": emb_umap
+    def _get_embeddings(cell_features, embeddings):
+        # Embeddings are only computed if requested
+        embedding_functions = {
+            "PCA": lambda: reduce_dimensions("PCA", cell_features, n_components=2),
+            "ICA": lambda: reduce_dimensions("FastICA", cell_features, n_components=2),
+            "Truncated SVD": lambda: reduce_dimensions("TruncatedSVD", cell_features, n_components=2),
+            "tSNE": lambda: reduce_dimensions("TSNE", cell_features, n_components=2, method='barnes_hut', init='pca'),
+            "UMAP": lambda: reduce_dimensions("UMAP", cell_features, n_components=2, n_neighbors=4, min_dist=0.3,
+                                              metric='correlation')
         }
 
+        embedded_data = {embedding_name: embedding_functions[embedding_name]() for embedding_name in embeddings}
+
         return embedded_data
 
     @staticmethod
-    def _get_classification_results(related_part_of_imputed_data, gold_standard_classes, repeats=10):
+    def _get_classification_results(cell_features, gold_standard_classes, repeats=10):
         svm_results = []
         knn_results = []
         for algorithm in ["svm", "knn"]:
             for i in range(repeats):
-                X_train, X_test, y_train, y_test = train_test_split(related_part_of_imputed_data.transpose().values,
+                X_train, X_test, y_train, y_test = train_test_split(cell_features,
                                                                     gold_standard_classes,
                                                                     test_size=0.25,
                                                                     shuffle=True)
@@ -198,6 +197,12 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
         normalization = kwargs['normalization']
         transformation = kwargs['transformation']
         clear_cache = kwargs['clear_cache']
+        seed = kwargs['seed']
+        # Embeddings can be selected by their slugs (e.g. `truncated_svd`), all of them are used by default
+        requested_embeddings = kwargs.get('embeddings')
+        embeddings = [embedding_name for embedding_name in self.EMBEDDINGS
+                      if requested_embeddings is None or
+                      embedding_name.replace(" ", "_").lower() in requested_embeddings]
 
         make_sure_dir_exists(os.path.join(result_dir, "files"))
         info = []
@@ -210,6 +215,7 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
             log("Observed some negative values!")
             imputed_data[imputed_data < 0] = 0
         imputed_data = transformations[transformation](normalizations[normalization](imputed_data))
+        imputed_data = imputed_data.astype(np.float32, copy=False)
 
         G1_S_related_part_of_imputed_data, G2_M_related_part_of_imputed_data = self._get_related_part(imputed_data)
 
@@ -230,29 +236,37 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
                      'plot_description': 'Heatmap of Genes related to G2/M',
                      })
 
-        svm_results, knn_results = self._get_classification_results(related_part_of_imputed_data,
-                                                                    gold_standard_classes)
+        # Cells x genes matrix
+        cell_features = np.ascontiguousarray(related_part_of_imputed_data.values.T)
 
-        embedded_data_file_path = os.path.join(result_dir, "files", "embedded_data.pkl.gz")
+        svm_results, knn_results = self._get_classification_results(cell_features, gold_standard_classes)
+
+        embedded_data_file_path = self._get_embedded_data_file_path(processed_count_file, normalization, transformation,
+                                                                    seed)
         if os.path.exists(embedded_data_file_path) and not clear_cache:
-            embedded_data = load_gzip_pickle(embedded_data_file_path)
+            log("Using cached embeddings from `%s`" % embedded_data_file_path)
+            cached_embedded_data = load_gzip_pickle(embedded_data_file_path)
         else:
-            embedded_data = self._get_embeddings(related_part_of_imputed_data)
-            dump_gzip_pickle(embedded_data, embedded_data_file_path)
+            cached_embedded_data = dict()
+        missing_embeddings = [embedding_name for embedding_name in embeddings
+                              if embedding_name not in cached_embedded_data]
+        if missing_embeddings:
+            cached_embedded_data.update(self._get_embeddings(cell_features, missing_embeddings))
+            dump_gzip_pickle(cached_embedded_data, embedded_data_file_path)
+        embedded_data = {embedding_name: cached_embedded_data[embedding_name] for embedding_name in embeddings}
 
         metric_results = {
             "classification_svm_mean_accuracy": np.mean(svm_results),
             "classification_knn_mean_accuracy": np.mean(knn_results)
         }
 
-        embedded_data["identity"] = related_part_of_imputed_data.transpose()
+        embedded_data["identity"] = cell_features
 
         for i, embedding_name in enumerate(embedded_data):
             emb = embedded_data[embedding_name]
 
-            k_means = KMeans(n_clusters=3)
-            k_means.fit(emb)
-            clusters = k_means.predict(emb)
+            k_means = KMeans(n_clusters=3, algorithm='elkan')
+            clusters = k_means.fit_predict(emb)
 
             embedding_slug = embedding_name.replace(" ", "_").lower()
 
@@ -309,7 +323,9 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
         G2_M_related_part_of_imputed_data = read_table_file(os.path.join(result_dir, "files",
                                                                          "G2_M_related_part_of_imputed_data.csv"))
 
-        embeddings = ["PCA", "ICA", "Truncated SVD", "tSNE", "UMAP"]
+        # Only evaluated embeddings are listed in info
+        embeddings = [embedding_name for embedding_name in self.EMBEDDINGS
+                      if "%s.csv" % embedding_name.replace(" ", "_").lower() in info.index]
         embedded_dfs = dict()
         for embedding_name in embeddings:
             embedding_slug = embedding_name.replace(" ", "_").lower()
@@ -318,31 +334,35 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
 
         if output_type == "pdf":
             import plotly.graph_objs as go
-            import plotly.io as pio
 
             G1_S_heatmap_fig = go.Figure(layout=go.Layout(title='Heatmap of Genes related to G1/S', font=dict(size=5),
                                                           xaxis=dict(title='Marker Genes', tickangle=60)))
             G2_M_heatmap_fig = go.Figure(layout=go.Layout(title='Heatmap of Genes related to G2/M', font=dict(size=5),
                                                           xaxis=dict(title='Marker Genes', tickangle=60)))
 
-            def normalize(df):
-                return df.subtract(df.mean(axis=1), axis=0).divide(df.std(axis=1), axis=0)
+            def normalize(values):
+                # Standardize rows (genes), same as pandas `(df - df.mean(1)) / df.std(1)`
+                return (values - values.mean(axis=1, keepdims=True)) / values.std(axis=1, ddof=1, keepdims=True)
 
-            G1_S_heatmap_fig.add_heatmap(z=normalize(G1_S_related_part_of_imputed_data).values.T,
+            G1_S_heatmap_fig.add_heatmap(z=normalize(G1_S_related_part_of_imputed_data.values).T,
                                          x=G1_S_related_part_of_imputed_data.index.values,
                                          y=G1_S_related_part_of_imputed_data.columns.values,
                                          colorscale='Viridis')
-            G2_M_heatmap_fig.add_heatmap(z=normalize(G2_M_related_part_of_imputed_data).values.T,
+            G2_M_heatmap_fig.add_heatmap(z=normalize(G2_M_related_part_of_imputed_data.values).T,
                                          x=G2_M_related_part_of_imputed_data.index.values,
                                          y=G2_M_related_part_of_imputed_data.columns.values,
                                          colorscale='Viridis')
 
-            pio.write_image(G1_S_heatmap_fig, os.path.join(result_dir, "plot_G1_S_related_genes_heatmap.pdf"),
-                            width=600, height=700)
-            pio.write_image(G2_M_heatmap_fig, os.path.join(result_dir, "plot_G2_M_related_genes_heatmap.pdf"),
-                            width=600, height=700)
+            write_image(G1_S_heatmap_fig, os.path.join(result_dir, "plot_G1_S_related_genes_heatmap.pdf"),
+                        width=600, height=700)
+            write_image(G2_M_heatmap_fig, os.path.join(result_dir, "plot_G2_M_related_genes_heatmap.pdf"),
+                        width=600, height=700)
+
+            # All embeddings share the same cells, so classes are indexed once
+            if embeddings:
+                classes = np.asarray(embedded_dfs[embeddings[0]]["class"].values)
+                indices_by_state = {state: np.flatnonzero(classes == state) for state in ["G1", "G2M", "S"]}
 
-            embeddings = ["PCA", "ICA", "Truncated SVD", "tSNE", "UMAP"]
             for i, embedding_name in enumerate(embeddings):
                 embedding_slug = embedding_name.replace(" ", "_").lower()
 
@@ -354,11 +374,10 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
                 embedding_df = embedded_dfs[embedding_name]
                 X = embedding_df["X"].values
                 Y = embedding_df["Y"].values
-                classes = embedding_df["class"].values
                 clusters = embedding_df["k_means_clusters"].values
 
                 for j, state in enumerate(["G1", "G2M", "S"]):
-                    indices = [k for k, c in enumerate(classes) if c == state]
+                    indices = indices_by_state[state]
                     fig.add_scatter(x=X[indices], y=Y[indices], mode='markers',
                                     marker=dict(color=["red", "green", "blue"][j],
                                                 symbol=[["circle-open", "diamond", "cross"][c]
@@ -366,8 +385,8 @@ class CellCyclePreservationEvaluator(AbstractEvaluator):
                                                 ),
                                     name="%s Phase" % state)
 
-                pio.write_image(fig, os.path.join(result_dir, "plot_%s.pdf" % embedding_slug),
-                                width=800, height=600)
+                write_image(fig, os.path.join(result_dir, "plot_%s.pdf" % embedding_slug),
+                            width=800, height=600)
 
         elif output_type == "html":
             raise NotImplementedError()
@@ -2,19 +2,18 @@ import os
 
 import numpy as np
 import pandas as pd
-import umap
 from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA, FastICA, TruncatedSVD
-from sklearn.manifold import TSNE
 from sklearn.metrics import adjusted_mutual_info_score, v_measure_score, calinski_harabaz_score, silhouette_score
 
 from data.data_set import get_data_set_class
 from data.io import write_csv, read_table_file
-from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, normalizations, transformations
+from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, normalizations, transformations, \
+    to_sparse, to_dense, remove_zero_rows
 from evaluators.base import AbstractEvaluator
 from general.conf import settings
 from utils.base import make_sure_dir_exists, dump_gzip_pickle, log, load_gzip_pickle
-from utils.plotting import ployly_symbols
+from utils.plotting import ployly_symbols, write_image
+from utils.reducers import reduce_dimensions
 
 
 class ClusteringEvaluator(AbstractEvaluator):
@@ -61,7 +60,7 @@ class ClusteringEvaluator(AbstractEvaluator):
         count_matrix, classes = self._load_data()
 
         # Remove zero rows
-        count_matrix = count_matrix[np.sum(count_matrix, axis=1) > 0].copy()
+        count_matrix = remove_zero_rows(count_matrix)
 
         # Shuffle columns
         count_matrix, original_columns, column_permutation = \
@@ -70,7 +69,7 @@ class ClusteringEvaluator(AbstractEvaluator):
         # Save hidden data
         make_sure_dir_exists(settings.STORAGE_DIR)
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        dump_gzip_pickle([count_matrix.to_sparse(), classes, original_columns, column_permutation],
+        dump_gzip_pickle([to_sparse(count_matrix), classes, original_columns, column_permutation],
                          hidden_data_file_path)
         log("Benchmark hidden data saved to `%s`" % hidden_data_file_path)
 
@@ -81,40 +80,41 @@ class ClusteringEvaluator(AbstractEvaluator):
     def _load_hidden_state(self):
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
         sparse_count_matrix, classes, original_columns, column_permutation = load_gzip_pickle(hidden_data_file_path)
-        count_matrix = sparse_count_matrix.to_dense()
+        count_matrix = to_dense(sparse_count_matrix)
 
         del sparse_count_matrix
 
         return count_matrix, classes, original_columns, column_permutation
 
-    def _get_embeddings(self, imputed_data):
-        log("Fitting PCA ...")
-        emb_pca = PCA(n_components=5). \
-            fit_transform(imputed_data.transpose())
+    @staticmethod
+    def _get_ica_embedding(cell_features):
         log("Fitting ICA ...")
-        emb_ica_2d = FastICA(n_components=2). \
-            fit_transform(imputed_data.transpose())
-        emb_ica = FastICA(n_components=5). \
-            fit_transform(imputed_data.transpose())
+        emb_ica_2d = reduce_dimensions("FastICA", cell_features, n_components=2)
+        emb_ica = reduce_dimensions("FastICA", cell_features, n_components=5)
+        return emb_ica, emb_ica_2d
+
+    def _get_embeddings(self, cell_features, ica=False):
+        embedded_data = dict()
+
+        log("Fitting PCA ...")
+        emb_pca = reduce_dimensions("PCA", cell_features, n_components=5)
+        embedded_data["PCA"] = (emb_pca, emb_pca)
+        # ICA is the slowest reducer, so it is only fitted on demand
+        if ica:
+            embedded_data["ICA"] = self._get_ica_embedding(cell_features)
         log("Fitting TruncatedSVD ...")
-        emb_tsvd = TruncatedSVD(n_components=5). \
-            fit_transform(imputed_data.transpose())
+        emb_tsvd = reduce_dimensions("TruncatedSVD", cell_features, n_components=5)
         log("Fitting TSNE ...")
-        emb_tsne_2d = TSNE(n_components=2, method='barnes_hut'). \
-            fit_transform(imputed_data.transpose())
-        emb_tsne = TSNE(n_components=3, method='barnes_hut'). \
-            fit_transform(imputed_data.transpose())
+        emb_tsne_2d = reduce_dimensions("TSNE", cell_features, n_components=2, method='barnes_hut')
+        emb_tsne = reduce_dimensions("TSNE", cell_features, n_components=3, method='barnes_hut')
         log("Fitting UMAP ...")
-        emb_umap = umap.UMAP(n_neighbors=4, min_dist=0.3, metric='correlation'). \
-            fit_transform(imputed_data.transpose())
+        emb_umap = reduce_dimensions("UMAP", cell_features, n_neighbors=4, min_dist=0.3, metric='correlation')
 
-        embedded_data = {
-            "PCA": (emb_pca, emb_pca),
-            "ICA": (emb_ica, emb_ica_2d),
+        embedded_data.update({
             "Truncated SVD": (emb_tsvd, emb_tsvd),
             "tSNE": (emb_tsne, emb_tsne_2d),
             "UMAP": (emb_umap, emb_umap)
-        }
+        })
 
         return embedded_data
 
@@ -122,6 +122,8 @@ class ClusteringEvaluator(AbstractEvaluator):
         normalization = kwargs['normalization']
         transformation = kwargs['transformation']
         clear_cache = kwargs['clear_cache']
+        seed = kwargs['seed']
+        ica = kwargs.get('ica', False)
 
         make_sure_dir_exists(os.path.join(result_dir, "files"))
         info = []
@@ -140,6 +142,7 @@ class ClusteringEvaluator(AbstractEvaluator):
             log("Observed some negative values!")
             imputed_data[imputed_data < 0] = 0
         imputed_data = transformations[transformation](normalizations[normalization](imputed_data))
+        imputed_data = imputed_data.astype(np.float32, copy=False)
 
         # Save class details for future
         write_csv(classes, os.path.join(result_dir, "files", "classes.csv" ))
@@ -147,24 +150,32 @@ class ClusteringEvaluator(AbstractEvaluator):
         # Evaluation
         metric_results = dict()
 
-        embedded_data_file_path = os.path.join(result_dir, "files", "embedded_data.pkl.gz")
+        embedded_data_file_path = self._get_embedded_data_file_path(processed_count_file_path,
+                                                                    normalization, transformation, seed)
         if os.path.exists(embedded_data_file_path) and not clear_cache:
+            log("Using cached embeddings from `%s`" % embedded_data_file_path)
             embedded_data = load_gzip_pickle(embedded_data_file_path)
+            if ica and "ICA" not in embedded_data:
+                embedded_data["ICA"] = self._get_ica_embedding(np.ascontiguousarray(imputed_data.values.T))
+                dump_gzip_pickle(embedded_data, embedded_data_file_path)
         else:
-            embedded_data = self._get_embeddings(imputed_data)
+            # Cells x genes matrix
+            embedded_data = self._get_embeddings(np.ascontiguousarray(imputed_data.values.T), ica=ica)
             dump_gzip_pickle(embedded_data, embedded_data_file_path)
+        if not ica:
+            embedded_data.pop("ICA", None)
 
         log("Evaluating ...")
         for class_label in classes.index.values:
             class_names = classes.loc[class_label].values
+            n_classes = np.unique(class_names).shape[0]
             for embedding_name in embedded_data:
                 emb, emb_2d = embedded_data[embedding_name]
 
                 embedding_slug = embedding_name.replace(" ", "_").lower()
 
-                k_means = KMeans(n_clusters=len(set(class_names)))
-                k_means.fit(emb)
-                clusters = k_means.predict(emb)
+                k_means = KMeans(n_clusters=n_classes, algorithm='elkan')
+                clusters = k_means.fit_predict(emb)
 
                 embedding_df = pd.DataFrame(emb)
                 embedding_df["X"] = emb_2d[:, 0]
@@ -208,14 +219,14 @@ class ClusteringEvaluator(AbstractEvaluator):
         return metric_results
 
     @staticmethod
-    def _get_color_scales(class_names):
+    def _get_color_scales(n_classes):
         import colorlover as cl
 
-        if len(set(class_names)) <= 20:
+        if n_classes <= 20:
             color_scale = (cl.scales['9']['qual']['Set1'] + cl.scales['12']['qual']['Set3'])
         else:
             color_scale = ['hsl(' + str(h) + ',50%' + ',50%)'
-                           for h in np.random.permutation(np.linspace(0, 350, len(set(class_names))))]
+                           for h in np.random.permutation(np.linspace(0, 350, n_classes))]
         return color_scale
 
     def visualize_result(self, result_dir, output_type, **kwargs):
@@ -227,25 +238,31 @@ class ClusteringEvaluator(AbstractEvaluator):
         embeddings = ["PCA", "ICA", "Truncated SVD", "tSNE", "UMAP"]
 
         if output_type == "pdf":
-            from plotly import graph_objs as go, io as pio
+            from plotly import graph_objs as go
 
             for class_label in classes.index.values:
                 class_names = classes.loc[class_label].astype("str").values
+                unique_class_names, class_indices = np.unique(class_names, return_inverse=True)
+                # Indices of cells in each class (classes are in the order of `unique_class_names`)
+                indices_by_class = np.split(np.argsort(class_indices, kind='mergesort'),
+                                            np.cumsum(np.bincount(class_indices))[:-1])
+                color_scale = self._get_color_scales(unique_class_names.shape[0])
                 for embedding_name in embeddings:
                     embedding_slug = embedding_name.replace(" ", "_").lower()
                     filename = "%s_%s.csv" % (class_label, embedding_slug)
+                    if filename not in info.index:  # Embedding was not evaluated (e.g. ICA is disabled)
+                        continue
                     embedded_df = read_table_file(os.path.join(result_dir, "files", filename))
 
                     fig = go.Figure(layout=go.Layout(title=info.loc[filename]["plot_description"],
                                                      font=dict(size=8)))
 
-                    color_scale = self._get_color_scales(class_names)
                     clusters = embedded_df["k_means_clusters"].values
                     X = embedded_df["X"].values
                     Y = embedded_df["Y"].values
 
-                    for i, class_name in enumerate(list(sorted(set(class_names)))):
-                        indices = [j for j, c in enumerate(class_names) if c == class_name]
+                    for i, class_name in enumerate(unique_class_names):
+                        indices = indices_by_class[i]
                         color = color_scale[i]
                         fig.add_scatter(x=X[indices], y=Y[indices], mode='markers',
                                         marker=dict(color=color, opacity=0.5,
@@ -254,8 +271,8 @@ class ClusteringEvaluator(AbstractEvaluator):
                                                     ),
                                         name=class_name)
 
-                    pio.write_image(fig, os.path.join(result_dir, "plot_%s_%s.pdf" % (class_label, embedding_slug)),
-                                    width=800, height=600)
+                    write_image(fig, os.path.join(result_dir, "plot_%s_%s.pdf" % (class_label, embedding_slug)),
+                                width=800, height=600)
         elif output_type == "html":
             raise NotImplementedError()
         else:
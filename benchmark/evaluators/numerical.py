@@ -2,15 +2,16 @@ import os
 
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import pdist
-from scipy.stats import pearsonr, spearmanr
 
 from data.data_set import get_data_set_class
 from data.io import write_csv, read_table_file
-from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, transformations
+from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, transformations, to_sparse, \
+    to_dense
 from evaluators.base import AbstractEvaluator
 from general import settings
 from utils.base import make_sure_dir_exists, log, dump_gzip_pickle, load_gzip_pickle
+from utils.plotting import write_image
+from utils.metrics import column_euclidean_distances, column_cosine_distances, column_correlation_distances
 
 
 class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
@@ -70,24 +71,14 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
 
         hvg_indices = self.get_hvg_genes(data, hvg_frac)
 
-        # Generate elimination mask
-        non_zero_locations = []
+        # Generate elimination mask (candidate locations are listed row by row)
+        candidate_rows, candidate_columns = np.nonzero(data.values[hvg_indices] >= min_expression)
+        candidate_rows = np.asarray(hvg_indices, dtype=int)[candidate_rows]
 
-        data_values = data.values
-        for x in hvg_indices:
-            for y in range(data.shape[1]):
-                if data_values[x, y] >= min_expression:
-                    non_zero_locations.append((x, y))
-        del data_values
+        mask = np.zeros_like(data.values)
 
-        mask = np.zeros_like(data)
-
-        masked_locations = [non_zero_locations[index] for index in
-                            np.random.choice(len(non_zero_locations),
-                                             dropout_count, replace=False)]
-
-        for (x, y) in masked_locations:
-            mask[x, y] = 1
+        masked_indices = np.random.choice(len(candidate_rows), dropout_count, replace=False)
+        mask[candidate_rows[masked_indices], candidate_columns[masked_indices]] = 1
 
         mask = pd.DataFrame(mask, index=data.index, columns=data.columns)
 
@@ -106,7 +97,7 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
         # Save hidden data
         make_sure_dir_exists(settings.STORAGE_DIR)
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        dump_gzip_pickle([data.to_sparse(), mask.to_sparse(), original_columns, column_permutation],
+        dump_gzip_pickle([to_sparse(data), to_sparse(mask), original_columns, column_permutation],
                          hidden_data_file_path)
         log("Benchmark hidden data saved to `%s`" % hidden_data_file_path)
 
@@ -118,8 +109,8 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
         sparse_data, sparse_mask, original_columns, column_permutation = \
             load_gzip_pickle(hidden_data_file_path)
-        data = sparse_data.to_dense()
-        mask = sparse_mask.to_dense()
+        data = to_dense(sparse_data)
+        mask = to_dense(sparse_mask)
 
         del sparse_data
         del sparse_mask
@@ -142,18 +133,20 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
         # Replace negative values with zero
         imputed_data = imputed_data.clip(lower=0)
 
-        # Evaluation
-        log_diff = np.abs(transformations["log"](data) - transformations["log"](imputed_data))
-        sqrt_diff = np.abs(transformations["sqrt"](data) - transformations["sqrt"](imputed_data))
+        # Evaluation (only masked entries which are non-zero in original data are considered)
+        is_evaluated = np.logical_and(mask.values != 0, data.values != 0)
+        original_evaluated_values = data.values[is_evaluated]
+        imputed_evaluated_values = imputed_data.values[is_evaluated]
+
+        log_diff = np.abs(transformations["log"](original_evaluated_values) -
+                          transformations["log"](imputed_evaluated_values))
+        sqrt_diff = np.abs(transformations["sqrt"](original_evaluated_values) -
+                           transformations["sqrt"](imputed_evaluated_values))
 
-        mse_on_log = float(np.sum(np.sum(mask * np.where(data != 0, 1, 0) * np.square(log_diff))) /
-                           np.sum(np.sum(mask * np.where(data != 0, 1, 0))))
-        mae_on_log = float(np.sum(np.sum(mask * np.where(data != 0, 1, 0) * np.abs(log_diff))) /
-                           np.sum(np.sum(mask * np.where(data != 0, 1, 0))))
-        mse_on_sqrt = float(np.sum(np.sum(mask * np.where(data != 0, 1, 0) * np.square(sqrt_diff))) /
-                            np.sum(np.sum(mask * np.where(data != 0, 1, 0))))
-        mae_on_sqrt = float(np.sum(np.sum(mask * np.where(data != 0, 1, 0) * np.abs(sqrt_diff))) /
-                            np.sum(np.sum(mask * np.where(data != 0, 1, 0))))
+        mse_on_log = float(np.mean(np.square(log_diff)))
+        mae_on_log = float(np.mean(log_diff))
+        mse_on_sqrt = float(np.mean(np.square(sqrt_diff)))
+        mae_on_sqrt = float(np.mean(sqrt_diff))
 
         metric_results = {
             'RMSE_sqrt': mse_on_sqrt ** 0.5,
@@ -162,21 +155,9 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
             'MAE_log': mae_on_log
         }
 
-        masked_locations = []
-        mask_values = mask.values
-        for x in range(mask_values.shape[0]):
-            for y in range(mask_values.shape[1]):
-                if mask_values[x, y] == 1:
-                    masked_locations.append((x, y))
-
-        original_values = []
-        predicted_values = []
-        for (x, y) in masked_locations:
-            original_values.append(data.iloc[x, y])
-            predicted_values.append(imputed_data.iloc[x, y])
-
-        original_values = np.asarray(original_values)
-        predicted_values = np.asarray(predicted_values)
+        masked_rows, masked_columns = np.nonzero(mask.values == 1)
+        original_values = data.values[masked_rows, masked_columns]
+        predicted_values = imputed_data.values[masked_rows, masked_columns]
 
         predictions_df = pd.DataFrame({'original': original_values, 'predicted': predicted_values})
         write_csv(predictions_df, os.path.join(result_dir, "files", "predictions.csv"))
@@ -196,11 +177,12 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
 
             file.write("##\n## ADDITIONAL INFO:\n")
             file.write("# GENE\tCELL\tGOLD_STANDARD\tRESULT:\n")
-            for (x, y) in masked_locations:
+            for x, y, original_value, predicted_value in zip(masked_rows, masked_columns,
+                                                             original_values, predicted_values):
                 file.write("# %s\t%s\t%f\t%f\n" % (data.index.values[x],
                                                    data.columns.values[y],
-                                                   data.iloc[x, y],
-                                                   imputed_data.iloc[x, y]))
+                                                   original_value,
+                                                   predicted_value))
 
         log("Evaluation results saved to `%s`" % result_path)
 
@@ -219,7 +201,6 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
 
         if output_type == "pdf":
             import plotly.graph_objs as go
-            import plotly.io as pio
 
             max_axis = float(max(original_values.max(), predicted_values.max()))
             for transformation_name in ["log", "sqrt"]:
@@ -232,8 +213,8 @@ class RandomMaskedLocationPredictionEvaluator(AbstractEvaluator):
                 fig.add_scatter(x=transformation(original_values),
                                 y=transformation(predicted_values),
                                 mode='markers', marker=dict(opacity=0.3))
-                pio.write_image(fig, os.path.join(result_dir, "prediction_plot_%s_scale.pdf" % transformation_name),
-                                width=800, height=800)
+                write_image(fig, os.path.join(result_dir, "prediction_plot_%s_scale.pdf" % transformation_name),
+                            width=800, height=800)
         elif output_type == "html":
             raise NotImplementedError()
         else:
@@ -279,18 +260,15 @@ class DownSampledDataReconstructionEvaluator(AbstractEvaluator):
         # find cumulative distribution (sum)
         data_values = data.astype(int).values
         n_all_reads = np.sum(data_values)
-        data_cumsum = np.reshape(np.cumsum(data_values), data_values.shape)
+        data_cumsum = np.cumsum(data_values)
 
         # Sample from original dataset
-        new_reads = np.sort(np.random.choice(n_all_reads, int(read_ratio * n_all_reads), replace=replce))
+        new_reads = np.random.choice(n_all_reads, int(read_ratio * n_all_reads), replace=replce)
 
-        low_quality_data = np.zeros_like(data_values)
-        read_index = 0
-        for x in range(data_values.shape[0]):
-            for y in range(data_values.shape[1]):
-                while read_index < len(new_reads) and new_reads[read_index] < data_cumsum[x, y]:
-                    low_quality_data[x, y] += 1
-                    read_index += 1
+        # Read `r` belongs to the first entry (in row-major order) whose cumulative sum exceeds `r`
+        read_locations = np.searchsorted(data_cumsum, new_reads, side='right')
+        low_quality_data = np.bincount(read_locations, minlength=data_values.size). \
+            reshape(data_values.shape).astype(data_values.dtype)
 
         # Convert to data frame
         low_quality_data = pd.DataFrame(low_quality_data, index=data.index, columns=data.columns)
@@ -306,7 +284,7 @@ class DownSampledDataReconstructionEvaluator(AbstractEvaluator):
         # Save hidden data
         make_sure_dir_exists(settings.STORAGE_DIR)
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        dump_gzip_pickle([data.to_sparse(), read_ratio, original_columns, column_permutation],
+        dump_gzip_pickle([to_sparse(data), read_ratio, original_columns, column_permutation],
                          hidden_data_file_path)
         log("Benchmark hidden data saved to `%s`" % hidden_data_file_path)
 
@@ -318,7 +296,7 @@ class DownSampledDataReconstructionEvaluator(AbstractEvaluator):
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
         sparse_data, read_ratio, original_columns, column_permutation = load_gzip_pickle(hidden_data_file_path)
 
-        scaled_data = sparse_data.to_dense() * read_ratio
+        scaled_data = to_dense(sparse_data) * read_ratio
 
         return scaled_data, original_columns, column_permutation
 
@@ -343,27 +321,21 @@ class DownSampledDataReconstructionEvaluator(AbstractEvaluator):
         scaled_data = transformations[transformation](scaled_data)
         imputed_data = transformations[transformation](imputed_data)
 
-        # Evaluation
-        rmse_distances = []
-        mae_distances = []
-        euclidean_distances = []
-        cosine_distances = []
-        correlation_distances = []
-
-        rmse = float(np.sum(np.where(scaled_data.values > 0, 1, 0) * np.square(scaled_data.values - imputed_data.values)) /
-                     np.sum(np.where(scaled_data.values > 0, 1, 0))) ** 0.5
-        mae = float(np.sum(np.where(scaled_data.values > 0, 1, 0) * np.abs(scaled_data.values - imputed_data.values)) /
-                    np.sum(np.where(scaled_data.values > 0, 1, 0)))
-
-        for i in range(scaled_data.shape[1]):
-            non_zeros = scaled_data.values[:, i] > 0
-            x = scaled_data.values[non_zeros, i]
-            y = imputed_data.values[non_zeros, i]
-            rmse_distances.append(float(np.sum(np.square(x - y)) / np.sum(non_zeros)) ** 0.5)
-            mae_distances.append(float(np.sum(np.abs(x - y)) / np.sum(non_zeros)))
-            cosine_distances.append(pdist(np.vstack((x, y)), 'cosine')[0])
-            euclidean_distances.append(pdist(np.vstack((x, y)), 'euclidean')[0])
-            correlation_distances.append(pdist(np.vstack((x, y)), 'correlation')[0])
+        # Evaluation (considering only non-zero entries of each cell)
+        non_zeros = scaled_data.values > 0
+        n_non_zeros = np.sum(non_zeros, axis=0)
+        diff = np.where(non_zeros, scaled_data.values - imputed_data.values, 0)
+
+        rmse = float(np.sum(np.square(diff)) / np.sum(n_non_zeros)) ** 0.5
+        mae = float(np.sum(np.abs(diff)) / np.sum(n_non_zeros))
+
+        # Per-cell distances (all cells at once)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rmse_distances = (np.sum(np.square(diff), axis=0) / n_non_zeros) ** 0.5
+            mae_distances = np.sum(np.abs(diff), axis=0) / n_non_zeros
+        cosine_distances = column_cosine_distances(scaled_data.values, imputed_data.values, non_zeros)
+        euclidean_distances = column_euclidean_distances(scaled_data.values, imputed_data.values, non_zeros)
+        correlation_distances = column_correlation_distances(scaled_data.values, imputed_data.values, non_zeros)
 
         metric_results = {
             'all_mean_absolute_error_on_non_zeros': mae,
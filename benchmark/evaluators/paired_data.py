@@ -2,14 +2,17 @@ import os
 
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import pdist
 
 from evaluators.base import AbstractEvaluator
 from general.conf import settings
 from utils.base import make_sure_dir_exists, dump_gzip_pickle, log, load_gzip_pickle
+from utils.plotting import write_image
+from utils.metrics import column_euclidean_distances, column_cosine_distances, column_correlation_distances, \
+    rank_rows, block_correlations, mean_squared_difference
 from data.data_set import get_data_set_class
-from data.io import write_csv, read_table_file
-from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, normalizations, transformations
+from data.io import write_csv, read_table_file, write_commented_table
+from data.operations import shuffle_and_rename_columns, rearrange_and_rename_columns, normalizations, transformations, \
+    to_sparse, to_dense, remove_zero_rows, sparse_to_arrays, arrays_to_sparse
 
 
 class PairedLQHQDataEvaluator(AbstractEvaluator):
@@ -56,8 +59,8 @@ class PairedLQHQDataEvaluator(AbstractEvaluator):
         # Save hidden data
         make_sure_dir_exists(settings.STORAGE_DIR)
         hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        dump_gzip_pickle([count_matrix_lq.to_sparse(), original_columns, column_permutation,
-                          count_matrix_hq.to_sparse()],
+        dump_gzip_pickle([to_sparse(count_matrix_lq), original_columns, column_permutation,
+                          to_sparse(count_matrix_hq)],
                          hidden_data_file_path)
         log("Benchmark hidden data saved to `%s`" % hidden_data_file_path)
 
@@ -70,8 +73,8 @@ class PairedLQHQDataEvaluator(AbstractEvaluator):
         sparse_count_matrix_lq, original_columns, column_permutation, sparse_count_matrix_hq = \
             load_gzip_pickle(hidden_data_file_path)
 
-        count_matrix_lq = sparse_count_matrix_lq.to_dense()
-        count_matrix_hq = sparse_count_matrix_hq.to_dense()
+        count_matrix_lq = to_dense(sparse_count_matrix_lq)
+        count_matrix_hq = to_dense(sparse_count_matrix_hq)
 
         del sparse_count_matrix_lq
         del sparse_count_matrix_hq
@@ -98,25 +101,24 @@ class PairedLQHQDataEvaluator(AbstractEvaluator):
         imputed_data = transformations[transformation](normalizations[normalization](imputed_data))
         count_matrix_hq = transformations[transformation](normalizations[normalization](count_matrix_hq))
 
-        # Evaluation
-        rmse_distances = []
-        mae_distances = []
-        euclidean_distances = []
-        cosine_distances = []
-        correlation_distances = []
-
-        for i in range(count_matrix_hq.shape[1]):
-            non_zeros = np.logical_and(count_matrix_hq.values[:, i] > 0, count_matrix_lq.values[:, i] == 0)
-            hq = count_matrix_hq.values[non_zeros, i]
-            lq = count_matrix_lq.values[non_zeros, i]
-            y = imputed_data.values[non_zeros, i]
-            if np.sum(y) > 0:
-                y = y * np.sum(hq) / np.sum(y)
-            rmse_distances.append(float(np.mean(np.square(hq - y) ** 0.5)))
-            mae_distances.append(float(np.mean(np.abs(hq - y))))
-            euclidean_distances.append(pdist(np.vstack((hq, y)), 'euclidean')[0])
-            cosine_distances.append(pdist(np.vstack((hq, y)), 'cosine')[0])
-            correlation_distances.append(pdist(np.vstack((hq, y)), 'correlation')[0])
+        # Evaluation (all cells at once, considering only entries with `hq > 0` and `lq == 0` in each cell)
+        non_zeros = np.logical_and(count_matrix_hq.values > 0, count_matrix_lq.values == 0)
+        n_non_zeros = np.sum(non_zeros, axis=0)
+        hq = np.where(non_zeros, count_matrix_hq.values, 0)
+        y = np.where(non_zeros, imputed_data.values, 0)
+
+        # Rescale imputed values of each cell to have the same sum as the high quality ones
+        y_sums = np.sum(y, axis=0)
+        scales = np.ones(y_sums.shape)
+        np.divide(np.sum(hq, axis=0), y_sums, out=scales, where=y_sums > 0)
+        y = y * scales
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rmse_distances = np.sum(np.square(hq - y) ** 0.5, axis=0) / n_non_zeros
+            mae_distances = np.sum(np.abs(hq - y), axis=0) / n_non_zeros
+        euclidean_distances = column_euclidean_distances(hq, y)
+        cosine_distances = column_cosine_distances(hq, y)
+        correlation_distances = column_correlation_distances(hq, y, non_zeros)
 
         metric_results = {
             'cell_root_mean_squared_error': np.mean(rmse_distances),
@@ -168,6 +170,7 @@ class CITESeqEvaluator(AbstractEvaluator):
         self.data_set_name = data_set_name
         self.data_set = None
         self.protein_rna_mapping = None
+        self._hidden_state_cache = None
 
     def prepare(self, **kwargs):
         if self.data_set_name is None:
@@ -213,32 +216,49 @@ class CITESeqEvaluator(AbstractEvaluator):
             shuffle_and_rename_columns(count_rna, disabled=preserve_columns)
 
         # Remove zero rows
-        count_rna = count_rna[np.sum(count_rna, axis=1) > 0].copy()
+        count_rna = remove_zero_rows(count_rna)
 
-        # Save hidden data
+        # Save hidden data (as named arrays, which can be loaded separately)
         make_sure_dir_exists(settings.STORAGE_DIR)
-        hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        dump_gzip_pickle([count_rna.to_sparse(), original_columns, column_permutation,
-                          count_adt.to_sparse(), self.protein_rna_mapping],
-                         hidden_data_file_path)
+        hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.npz" % self.uid)
+        proteins = sorted(self.protein_rna_mapping)
+        np.savez_compressed(hidden_data_file_path,
+                            original_columns=np.asarray(original_columns, dtype=str),
+                            column_permutation=np.asarray(column_permutation),
+                            proteins=np.asarray(proteins, dtype=str),
+                            genes=np.asarray([self.protein_rna_mapping[prot] for prot in proteins], dtype=str),
+                            **sparse_to_arrays(to_sparse(count_rna), "rna_"),
+                            **sparse_to_arrays(to_sparse(count_adt), "adt_"))
         log("Benchmark hidden data saved to `%s`" % hidden_data_file_path)
 
         make_sure_dir_exists(os.path.dirname(count_file_path))
         write_csv(count_rna, count_file_path)
         log("Count file saved to `%s`" % count_file_path)
 
-    def _load_hidden_state(self):
-        hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)
-        sparse_count_rna, original_columns, column_permutation, sparse_count_adt, protein_rna_mapping = \
-            load_gzip_pickle(hidden_data_file_path)
+    def _load_hidden_state(self, with_count_rna=True):
+        hidden_data_file_path = os.path.join(settings.STORAGE_DIR, "%s.hidden.npz" % self.uid)
+        if not os.path.exists(hidden_data_file_path) and \
+                os.path.exists(os.path.join(settings.STORAGE_DIR, "%s.hidden.pkl.gz" % self.uid)):
+            raise ValueError("Test bench `%s` was generated in an old format, please regenerate it." % self.uid)
+
+        # Hidden state is reused by consecutive evaluations (e.g. with different transformations) until it changes
+        cache_key = (hidden_data_file_path, os.path.getmtime(hidden_data_file_path), with_count_rna)
+        if self._hidden_state_cache is not None and self._hidden_state_cache[0] == cache_key:
+            return self._hidden_state_cache[1]
 
-        count_rna = sparse_count_rna.to_dense()
-        count_adt = sparse_count_adt.to_dense()
+        with np.load(hidden_data_file_path) as hidden_data:
+            original_columns = hidden_data["original_columns"]
+            column_permutation = hidden_data["column_permutation"]
+            protein_rna_mapping = dict(zip(hidden_data["proteins"], hidden_data["genes"]))
 
-        del sparse_count_rna
-        del sparse_count_adt
+            # RNA counts are the largest part of hidden state, so they are only read if needed
+            count_rna = to_dense(arrays_to_sparse(hidden_data, "rna_")) if with_count_rna else None
+            count_adt = to_dense(arrays_to_sparse(hidden_data, "adt_"))
 
-        return count_rna, original_columns, column_permutation, count_adt, protein_rna_mapping
+        hidden_state = count_rna, original_columns, column_permutation, count_adt, protein_rna_mapping
+        self._hidden_state_cache = (cache_key, hidden_state)
+
+        return hidden_state
 
     def evaluate_result(self, processed_count_file_path, result_dir, visualization, **kwargs):
         make_sure_dir_exists(os.path.join(result_dir, "files"))
@@ -246,23 +266,43 @@ class CITESeqEvaluator(AbstractEvaluator):
         transformation = kwargs['transformation']
 
         # Load hidden state and data
-        _, original_columns, column_permutation, count_adt, protein_rna_mapping = self._load_hidden_state()
+        _, original_columns, column_permutation, count_adt, protein_rna_mapping = \
+            self._load_hidden_state(with_count_rna=False)
 
         # Load imputed data
         imputed_rna = read_table_file(processed_count_file_path)
 
+        # Use related data (genes are looked up in the index hash table instead of scanning it per protein).
+        # Only these rows are used, so they are selected before any other operation on the whole data
+        related_genes = pd.Index([protein_rna_mapping[prot] for prot in count_adt.index.values])
+        is_available = related_genes.isin(imputed_rna.index)
+        adt = count_adt.loc[is_available]
+        rna = imputed_rna.reindex(related_genes[is_available])
+
+        del imputed_rna
+
         # Restore column names and order
-        imputed_rna = rearrange_and_rename_columns(imputed_rna, original_columns, column_permutation)
+        rna = rearrange_and_rename_columns(rna, original_columns, column_permutation)
+        # Same order of cells as adt
+        rna = rna[adt.columns]
 
         # Data transformations
-        imputed_rna = transformations[transformation](imputed_rna)
-        count_adt = transformations[transformation](count_adt)
-
-        # Use related data
-        adt = count_adt.loc[[prot for prot in count_adt.index.values if (protein_rna_mapping[prot] in imputed_rna.index.values)]].copy()
-        adt.index = ["prot_" + p for p in adt.index.values]
-        rna = imputed_rna.loc[[protein_rna_mapping[prot] for prot in count_adt.index.values if (protein_rna_mapping[prot] in imputed_rna.index.values)]]
-        rna.index = ["gene_" + g for g in rna.index.values]
+        rna = transformations[transformation](rna)
+        adt = transformations[transformation](adt)
+        rna = rna.astype(np.float32, copy=False)
+        adt = adt.astype(np.float32, copy=False)
+
+        adt.index = "prot_" + adt.index.astype(str)
+        rna.index = "gene_" + rna.index.astype(str)
+
+        # Correlations of constant values are undefined, so such protein/gene pairs are not evaluated
+        is_variable = (np.max(adt.values, axis=1) > np.min(adt.values, axis=1)) & \
+                      (np.max(rna.values, axis=1) > np.min(rna.values, axis=1))
+        if not np.all(is_variable):
+            log("Ignoring constant protein/gene pairs: %s" %
+                ", ".join("%s/%s" % pair for pair in zip(adt.index[~is_variable], rna.index[~is_variable])))
+            adt = adt.loc[is_variable]
+            rna = rna.loc[is_variable]
 
         info = []
 
@@ -278,15 +318,18 @@ class CITESeqEvaluator(AbstractEvaluator):
                      'plot_description': 'Gene expressions of genes related to adt data after transformation',
                      })
 
-        n = adt.shape[0]
+        # Only adt/adt, rna/rna and adt/rna blocks are calculated (rna/adt is the transpose of adt/rna)
+        combined_index = adt.index.append(rna.index)
+        # Row-major values are extracted once (pandas stores them column-major) and shared by both correlations
+        adt_values = np.ascontiguousarray(adt.values)
+        rna_values = np.ascontiguousarray(rna.values)
 
         # Calculating Spearman correlations
-        combined_df = pd.concat((adt, rna)).transpose()
-        correlations = combined_df.corr(method="spearman")
-
-        adt_adt_spearmanr = correlations.iloc[:n, :n]
-        rna_rna_spearmanr = correlations.iloc[n:, n:]
-        adt_rna_spearmanr = correlations.iloc[:n, n:]
+        adt_adt_spearmanr, rna_rna_spearmanr, adt_rna_spearmanr = \
+            block_correlations(rank_rows(adt_values).astype(np.float32), rank_rows(rna_values).astype(np.float32))
+        correlations = pd.DataFrame(np.block([[adt_adt_spearmanr, adt_rna_spearmanr],
+                                              [adt_rna_spearmanr.T, rna_rna_spearmanr]]),
+                                    index=combined_index, columns=combined_index)
 
         write_csv(correlations, os.path.join(result_dir, "files", "spearman_correlations.csv"))
         info.append({'filename': "spearman_correlations.csv",
@@ -297,12 +340,10 @@ class CITESeqEvaluator(AbstractEvaluator):
                      })
 
         # Calculating Pearson correlations
-        combined_df = pd.concat((adt, rna)).transpose()
-        correlations = combined_df.corr(method="pearson")
-
-        adt_adt_pearsonr = correlations.iloc[:n, :n]
-        rna_rna_pearsonr = correlations.iloc[n:, n:]
-        adt_rna_pearsonr = correlations.iloc[:n, n:]
+        adt_adt_pearsonr, rna_rna_pearsonr, adt_rna_pearsonr = block_correlations(adt_values, rna_values)
+        correlations = pd.DataFrame(np.block([[adt_adt_pearsonr, adt_rna_pearsonr],
+                                              [adt_rna_pearsonr.T, rna_rna_pearsonr]]),
+                                    index=combined_index, columns=combined_index)
 
         write_csv(correlations, os.path.join(result_dir, "files", "pearson_correlations.csv"))
         info.append({'filename': "pearson_correlations.csv",
@@ -312,14 +353,14 @@ class CITESeqEvaluator(AbstractEvaluator):
                                          'adt expressions and second n items are rna expressions)',
                      })
 
-        # Evaluation
+        # Evaluation (on correlation arrays, data frames are only built for reports)
         metric_results = {
-            'rna_protein_mean_spearman_correlatoin': np.mean(adt_rna_spearmanr.values.diagonal()),
-            'rna_protein_mean_pearson_correlatoin': np.mean(adt_rna_pearsonr.values.diagonal()),
+            'rna_protein_mean_spearman_correlatoin': np.trace(adt_rna_spearmanr) / adt_rna_spearmanr.shape[0],
+            'rna_protein_mean_pearson_correlatoin': np.trace(adt_rna_pearsonr) / adt_rna_pearsonr.shape[0],
             'MSE_of_adt_adt_and_rna_rna_spearman_correlations':
-                np.mean((adt_adt_spearmanr.values - rna_rna_spearmanr.values) ** 2),
+                mean_squared_difference(adt_adt_spearmanr, rna_rna_spearmanr),
             'MSE_of_adt_adt_and_rna_rna_pearson_correlations':
-                np.mean((adt_adt_pearsonr.values - rna_rna_pearsonr.values) ** 2)
+                mean_squared_difference(adt_adt_pearsonr, rna_rna_pearsonr)
         }
 
         write_csv(pd.DataFrame(info), os.path.join(result_dir, "files", "info.csv"))
@@ -333,17 +374,17 @@ class CITESeqEvaluator(AbstractEvaluator):
 
             file.write("##\n## ADDITIONAL INFO:\n")
             file.write("## Pearson of adt/rna:\n")
-            file.write("## " + "\n## ".join(adt_rna_pearsonr.to_string().split("\n")) + "\n")
+            write_commented_table(pd.DataFrame(adt_rna_pearsonr, index=adt.index, columns=rna.index), file)
             file.write('## Spearman of adt/rna:\n')
-            file.write("## " + "\n## ".join(adt_rna_spearmanr.to_string().split("\n")) + "\n")
+            write_commented_table(pd.DataFrame(adt_rna_spearmanr, index=adt.index, columns=rna.index), file)
             file.write("## Pearson of adt/adt:\n")
-            file.write("## " + "\n## ".join(adt_adt_pearsonr.to_string().split("\n")) + "\n")
+            write_commented_table(pd.DataFrame(adt_adt_pearsonr, index=adt.index, columns=adt.index), file)
             file.write("## Pearson of rna/rna:\n")
-            file.write("## " + "\n## ".join(rna_rna_pearsonr.to_string().split("\n")) + "\n")
+            write_commented_table(pd.DataFrame(rna_rna_pearsonr, index=rna.index, columns=rna.index), file)
             file.write('## Spearman of adt/adt:\n')
-            file.write("## " + "\n## ".join(adt_adt_spearmanr.to_string().split("\n")) + "\n")
+            write_commented_table(pd.DataFrame(adt_adt_spearmanr, index=adt.index, columns=adt.index), file)
             file.write('## Spearman of rna/rna:\n')
-            file.write("## " + "\n## ".join(rna_rna_spearmanr.to_string().split("\n")) + "\n")
+            write_commented_table(pd.DataFrame(rna_rna_spearmanr, index=rna.index, columns=rna.index), file)
 
         log("Evaluation results saved to `%s`" % result_path)
 
@@ -371,7 +412,6 @@ class CITESeqEvaluator(AbstractEvaluator):
 
         if output_type == "pdf":
             import plotly.graph_objs as go
-            import plotly.io as pio
 
             plots = [
                 ("Pairwise Spearman correlations between ADT values", adt_adt_spearmanr,
@@ -394,8 +434,8 @@ class CITESeqEvaluator(AbstractEvaluator):
                                 y=data_frame.index.values,
                                 colorscale='Picnic')  # RdBu is also good
 
-                pio.write_image(fig, os.path.join(result_dir, filename),
-                                width=600, height=700)
+                write_image(fig, os.path.join(result_dir, filename),
+                            width=600, height=700)
 
         elif output_type == "html":
             print("Nothing to visualize")
@@ -11,6 +11,9 @@ STATIC_FILES_DIR = os.path.join(os.path.join(BASE_DIR, "static"))
 CACHE_DIR = os.path.join(os.path.join(FILES_DIR, "cache"))
 STORAGE_DIR = os.path.join(os.path.join(FILES_DIR, "storage"))
 
+# Dimension reductions on at least this many cells run on GPU (only if cuML is installed)
+GPU_MIN_N_SAMPLES = 1000
+
 # Available data sets
 data_sets = {
     'ERP006670': "data.data_set.DataSet_ERP006670",
@@ -73,7 +73,8 @@ def evaluate_cell_cycle_test(args):
     evaluator = CellCyclePreservationEvaluator(uid)
     evaluator.set_seed(args.seed)
     results = evaluator.evaluate_result(args.input, args.result_dir, visualization=args.visualization, clear_cache=args.clear_cache,
-                                        normalization=args.normalization, transformation=args.transformation)
+                                        normalization=args.normalization, transformation=args.transformation,
+                                        embeddings=args.embeddings, seed=args.seed)
     print_metric_results(results)
 
 
@@ -82,7 +83,8 @@ def evaluate_clustering_test(args):
     evaluator = ClusteringEvaluator(uid)
     evaluator.set_seed(args.seed)
     results = evaluator.evaluate_result(args.input, args.result_dir, visualization=args.visualization, clear_cache=args.clear_cache,
-                                        normalization=args.normalization, transformation=args.transformation)
+                                        normalization=args.normalization, transformation=args.transformation,
+                                        ica=args.ica, seed=args.seed)
     print_metric_results(results)
 
 
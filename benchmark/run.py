@@ -122,6 +122,10 @@ def generate_parser():
                                             help='Transformation to be applied before evaluation.')
     parser_evaluate_cell_cycle.add_argument('--clear-cache', '--cc', action='store_true',
                                             help='Clear embedding cache if available.')
+    parser_evaluate_cell_cycle.add_argument('--embeddings', nargs='+',
+                                            choices=['pca', 'ica', 'truncated_svd', 'tsne', 'umap'],
+                                            default=['pca', 'ica', 'truncated_svd', 'tsne', 'umap'],
+                                            help='Embeddings to be evaluated (other embeddings are not computed).')
 
     parser_evaluate_clustering = subparsers_evaluate.add_parser('clustering')
     parser_evaluate_clustering.set_defaults(function=evaluate_clustering_test)
@@ -131,6 +135,8 @@ def generate_parser():
                                             help='Transformation to be applied before evaluation.')
     parser_evaluate_clustering.add_argument('--clear-cache', '--cc', action='store_true',
                                             help='Clear embedding cache if available.')
+    parser_evaluate_clustering.add_argument('--ica', action='store_true',
+                                            help='Also evaluate ICA embeddings (slowest of the embeddings).')
 
     parser_evaluate_random_mask = subparsers_evaluate.add_parser('random-mask')
     parser_evaluate_random_mask.set_defaults(function=evaluate_random_mask_test)
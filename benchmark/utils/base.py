@@ -151,9 +151,11 @@ def load_class(class_path):
     return loaded_class
 
 
-def dump_gzip_pickle(obj, path):
-    with gzip.open(path, 'wb') as file:
-        pickle.dump(obj, file)
+def dump_gzip_pickle(obj, path, compresslevel=3):
+    # Highest protocol stores numpy buffers (e.g. sparse count matrices) in binary form, and a low compression
+    # level is much faster than gzip's default (9) while integer counts are still compressed well
+    with gzip.open(path, 'wb', compresslevel=compresslevel) as file:
+        pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def load_gzip_pickle(path):
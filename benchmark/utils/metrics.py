@@ -0,0 +1,80 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from scipy.stats import rankdata
+
+
+# Column-wise (per-cell) distances between two (genes x cells) matrices.
+# Entries outside `mask` are ignored, equivalent to calling `pdist` on each pair of masked columns.
+
+def _apply_mask(x, mask):
+    if mask is None:
+        return x
+    return np.where(mask, x, 0)
+
+
+def column_euclidean_distances(x, y, mask=None):
+    diff = _apply_mask(x - y, mask)
+    return np.sqrt(np.einsum('ij,ij->j', diff, diff))
+
+
+def column_cosine_distances(x, y, mask=None):
+    x = _apply_mask(x, mask)
+    y = _apply_mask(y, mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - np.einsum('ij,ij->j', x, y) / np.sqrt(np.einsum('ij,ij->j', x, x) * np.einsum('ij,ij->j', y, y))
+
+
+def column_correlation_distances(x, y, mask=None):
+    if mask is None:
+        mask = np.ones(x.shape, dtype=bool)
+    n = np.sum(mask, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_centered = x - np.sum(_apply_mask(x, mask), axis=0) / n
+        y_centered = y - np.sum(_apply_mask(y, mask), axis=0) / n
+    return column_cosine_distances(x_centered, y_centered, mask)
+
+
+def mean_squared_difference(x, y):
+    # Squared differences are summed by einsum without another temporary array
+    diff = np.subtract(x, y)
+    return np.einsum('ij,ij->', diff, diff) / diff.size
+
+
+def rank_rows(x):
+    # Spearman correlations are Pearson correlations of ranks (without p-values of `spearmanr`)
+    return np.apply_along_axis(rankdata, 1, x)
+
+
+def _standardize_rows(x):
+    # Rows are centered into a new array which is then scaled in place
+    x = x - np.mean(x, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x /= np.sqrt(np.einsum('ij,ij->i', x, x))[:, np.newaxis]
+    return x
+
+
+@contextmanager
+def _limited_blas_threads(n_operations):
+    # Small products get slower with many BLAS threads, so threads are limited to the amount of work
+    # (only if threadpoolctl is installed)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+    if threadpool_limits is None:
+        yield
+        return
+    with threadpool_limits(limits=min(os.cpu_count() or 1, max(1, n_operations // 2 ** 22)), user_api='blas'):
+        yield
+
+
+def block_correlations(x, y):
+    # Pearson correlations between rows of `x`, between rows of `y` and between rows of `x` and `y`,
+    # the same blocks of `np.corrcoef(np.vstack((x, y)))` without computing the redundant (y, x) block
+    x = _standardize_rows(x)
+    y = _standardize_rows(y)
+    with _limited_blas_threads((x.shape[0] + y.shape[0]) ** 2 * x.shape[1]):
+        blocks = [np.dot(x, x.T), np.dot(y, y.T), np.dot(x, y.T)]
+    return tuple(np.clip(block, -1, 1, out=block) for block in blocks)
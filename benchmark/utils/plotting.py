@@ -27,3 +27,13 @@ ployly_symbols = ["square", "star", "diamond", "circle-cross-open", "bowtie-open
                   "y-down-open", "star-triangle-down-open", "y-up", "triangle-se", "hexagon2-dot", "line-ne",
                   "pentagon-dot", "diamond-tall-open-dot", "circle-cross", "circle-dot", "triangle-up-dot",
                   "triangle-ne-open", "octagon-open-dot", "star-open-dot", "hash", "hexagon2-open-dot"]
+
+
+def write_image(fig, file_path, **kwargs):
+    # Kaleido (plotly>=4.9 with `kaleido` installed) renders in-process and
+    # avoids the external orca server used by older plotly versions.
+    import plotly.io as pio
+
+    if getattr(getattr(pio, "kaleido", None), "scope", None) is not None:
+        kwargs["engine"] = "kaleido"
+    pio.write_image(fig, file_path, **kwargs)
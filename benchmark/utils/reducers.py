@@ -0,0 +1,51 @@
+import numpy as np
+
+from general.conf import settings
+from utils.base import load_class, log
+
+CPU_REDUCERS = {
+    "PCA": "sklearn.decomposition.PCA",
+    "FastICA": "sklearn.decomposition.FastICA",
+    "TruncatedSVD": "sklearn.decomposition.TruncatedSVD",
+    "TSNE": "sklearn.manifold.TSNE",
+    "UMAP": "umap.UMAP"
+}
+
+# cuML counterparts (used only if cuML is installed)
+GPU_REDUCERS = {
+    "PCA": "cuml.PCA",
+    "TruncatedSVD": "cuml.TruncatedSVD",
+    "TSNE": "cuml.TSNE",
+    "UMAP": "cuml.UMAP"
+}
+
+
+def _is_supported_on_gpu(reducer_name, **kwargs):
+    if reducer_name not in GPU_REDUCERS:
+        return False
+    if reducer_name == "TSNE" and kwargs.get("n_components", 2) != 2:  # cuML only supports 2D t-SNE
+        return False
+    if kwargs.get("metric") == "precomputed":
+        return False
+    return True
+
+
+def get_reducer_class(reducer_name, n_samples, **kwargs):
+    if n_samples >= settings.GPU_MIN_N_SAMPLES and _is_supported_on_gpu(reducer_name, **kwargs):
+        try:
+            reducer_class = load_class(GPU_REDUCERS[reducer_name])
+            log("Using cuML implementation of %s." % reducer_name)
+            return reducer_class
+        except ImportError:
+            pass
+    return load_class(CPU_REDUCERS[reducer_name])
+
+
+def reduce_dimensions(reducer_name, data, **kwargs):
+    """
+    Fits a dimension reduction method on `data` (samples x features) and returns the embedding.
+    Uses GPU (cuML) implementations when available and data is large enough.
+    """
+    data = np.asarray(data)
+    reducer_class = get_reducer_class(reducer_name, data.shape[0], **kwargs)
+    return np.asarray(reducer_class(**kwargs).fit_transform(data))